@@ -1,12 +1,11 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import time
+import numpy as np
+import xlsxwriter
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 from io import BytesIO
-from difflib import SequenceMatcher
-
-# Aumentamos límite de renderizado por si acaso
-pd.set_option("styler.render.max_elements", 2000000)
+from rapidfuzz import fuzz, process
 
 # --- 1. CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(
@@ -35,38 +34,259 @@ st.markdown("""
 
 # --- 3. FUNCIONES AUXILIARES ---
 
-def clean_currency(x):
-    if isinstance(x, str):
-        clean = x.replace('$', '').replace(',', '').strip()
-        try: return float(clean)
-        except: return 0.0
-    return x
-
-def determine_status(val):
-    if pd.isna(val): return "Sin Info"
-    if abs(val) < 0.005: return 'Precio sin cambios'
-    elif val > 0: return 'Precio subió'
-    else: return 'Precio bajó'
-
-def calculate_similarity(row):
-    desc_erp = str(row['Descripción_Insignia']).lower().strip()
-    desc_prov = str(row['Desc_Prov']).lower().strip()
-    if not desc_erp or desc_erp == 'nan' or not desc_prov or desc_prov == 'nan':
-        return 0.0
-    return SequenceMatcher(None, desc_erp, desc_prov).ratio() * 100
-
-def load_data(file):
+def clean_currency_col(s):
+    # Columna ya numérica (el lector la tipó así): sin pasar por texto
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        return s.astype(float).round(2)
+    # Vectorizado: textos no numéricos -> 0.0, celdas vacías siguen como NaN
+    clean = s.astype(str).str.replace(r'[$,]', '', regex=True).str.strip()
+    num = pd.to_numeric(clean, errors='coerce')
+    return num.mask(num.isna() & s.notna(), 0.0).round(2)
+
+ESTADOS = ['Precio subió', 'Precio bajó', 'Precio sin cambios', 'Sin Info']
+
+def diff_cents(new, old):
+    # Diferencia exacta en centavos (int64); int64 no admite NaN, así que los faltantes van en una máscara
+    a, b = new.to_numpy(dtype=float), old.to_numpy(dtype=float)
+    missing = np.isnan(a) | np.isnan(b)
+    cents = np.rint(np.where(missing, 0, a) * 100).astype(np.int64) - np.rint(np.where(missing, 0, b) * 100).astype(np.int64)
+    return cents, missing
+
+# Signo de la diferencia (-1, 0, 1) + 1 -> posición en ESTADOS
+SIGNO_A_ESTADO = np.array([1, 2, 0], dtype=np.int8)
+
+def determine_status_col(cents, missing):
+    # En centavos "sin cambios" es == 0 exacto; los códigos int8 se etiquetan con from_codes, sin arrays de texto
+    codes = np.where(missing, 3, SIGNO_A_ESTADO[np.sign(cents) + 1]).astype(np.int8)
+    return pd.Categorical.from_codes(codes, categories=ESTADOS)
+
+# Ícono por estado para la vista previa (mismos colores que usaba el Styler)
+ICONOS_ESTADO = {'Precio subió': '🔴', 'Precio bajó': '🔵', 'Precio sin cambios': '🟢'}
+
+def with_status_icons(col):
+    # column_config no colorea celdas; se renombran las categorías (costo O(#categorías), no por fila)
+    if not isinstance(col.dtype, pd.CategoricalDtype): return col
+    return col.cat.rename_categories(lambda c: f"{ICONOS_ESTADO[c]} {c}" if c in ICONOS_ESTADO else c)
+
+def similarity_band(col):
+    # Mismas bandas que coloreaba el Styler: < 50 rojo, < 80 naranja, resto verde
+    v = col.to_numpy(dtype=float)
+    return np.select([np.isnan(v), v < 50, v < 80], ['', '🔴', '🟠'], default='🟢')
+
+def shared_category(*cols):
+    # Mismo CategoricalDtype en todas las columnas: merge/isin trabajan sobre códigos int
+    cats = pd.concat([c.drop_duplicates() for c in cols]).dropna().unique()
+    dtype = pd.CategoricalDtype(cats)
+    return [c.astype(dtype) for c in cols]
+
+def join_on_code(left, right, how):
+    # right viene indexado por código. Con códigos únicos basta un reindex (get_indexer + take),
+    # bastante más rápido que join/merge; con duplicados se mantiene el join (una fila por coincidencia)
+    if not right.index.is_unique:
+        return left.join(right, on='Codigo_Prov', how=how).reset_index(drop=True)
+    if how == 'inner':
+        left = left[left['Codigo_Prov'].isin(right.index)]
+    matched = right.reindex(left['Codigo_Prov'])
+    return pd.concat([left.reset_index(drop=True), matched.reset_index(drop=True)], axis=1)
+
+def calculate_similarity(desc_erp, desc_prov):
+    # rapidfuzz (C++) calcula todos los pares en un solo llamado, repartido en todos los núcleos; vacíos / 'nan' -> 0
+    # Cada par de descripciones distinto se normaliza y puntúa una sola vez, y se reparte a sus filas
+    ca, ua = pd.factorize(desc_erp, use_na_sentinel=False)
+    cb, ub = pd.factorize(desc_prov, use_na_sentinel=False)
+    _, first, inverse = np.unique(ca.astype(np.int64) * len(ub) + cb, return_index=True, return_inverse=True)
+    a = pd.Series(ua).astype(str).str.lower().str.strip().iloc[ca[first]]
+    b = pd.Series(ub).astype(str).str.lower().str.strip().iloc[cb[first]]
+    a, b = a.to_numpy(), b.to_numpy()
+    valid = (pd.notna(a) & ~np.isin(a, ['', 'nan'])) & (pd.notna(b) & ~np.isin(b, ['', 'nan']))
+    # Textos idénticos valen 100 sin pasar por el matcher
+    same = valid & (a == b)
+    todo = valid & ~same
+    sims = np.where(same, 100.0, 0.0)
+    sims[todo] = process.cpdist(a[todo], b[todo], scorer=fuzz.ratio, dtype=np.float64, workers=-1)
+    return sims[inverse]
+
+@st.cache_data(show_spinner=False, max_entries=5)
+def to_excel_bytes(df, sheet_name):
+    # constant_memory escribe y libera fila por fila. pandas.to_excel no sirve en este modo
+    # (emite las celdas por columna y xlsxwriter descartaría las filas ya cerradas)
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    sheet = workbook.add_worksheet(sheet_name)
+    header_fmt = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    sheet.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    for i, row in enumerate(rows, start=1):
+        sheet.write_row(i, 0, row)
+    workbook.close()
+    return output.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=5)
+def to_parquet_bytes(df):
+    # Columnar (pyarrow + zstd): mucho más rápido de generar y más liviano que el xlsx
+    output = BytesIO()
+    df.to_parquet(output, engine='pyarrow', compression='zstd', index=False)
+    return output.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=5)
+def to_csv_bytes(df):
+    # utf-8-sig: Excel abre el CSV con tildes y ñ correctas
+    return df.to_csv(index=False).encode('utf-8-sig')
+
+# Formato -> (generador, extensión, mime). Excel sigue siendo el formato por defecto
+FORMATOS_DESCARGA = {
+    'Excel': (lambda df: to_excel_bytes(df, 'Reporte_Unificado'), 'xlsx', 'application/vnd.ms-excel'),
+    'CSV': (to_csv_bytes, 'csv', 'text/csv'),
+    'Parquet': (to_parquet_bytes, 'parquet', 'application/vnd.apache.parquet')
+}
+
+# Posición de columna en el archivo -> nombre interno
+ERP_COLS = {0: 'Codigo_Insignia', 2: 'Descripción_Insignia', 18: 'Codigo_ERP', 14: 'Precio_Publico_ERP', 20: 'Precio_Costo_ERP'}
+PUB_COLS = {0: 'Codigo_Prov', 1: 'Desc_Prov', 2: 'Precio_Publico_Prov'}
+COST_COLS = {0: 'Codigo_Prov', 9: 'Precio_Costo_Prov'}
+
+# Columnas de cruce: un código numérico se compara por su valor, como cuando pandas lo leía como número
+JOIN_CODES = ('Codigo_ERP', 'Codigo_Prov')
+
+def canonical_code(s):
+    # '001000', '1000' y '1000.0' -> '1000'; los códigos alfanuméricos ('00A1') no se tocan
+    return s.str.replace(r'^0*(\d+?)(?:\.0*)?$', r'\1', regex=True)
+
+def normalize(df):
+    # Construye el subset final en una sola pasada: textos sin espacios, precios numéricos
+    return pd.DataFrame({
+        c: clean_currency_col(df[c]) if c.startswith('Precio_')
+        else canonical_code(df[c].astype(str).str.strip()) if c in JOIN_CODES
+        else df[c].astype(str).str.strip()
+        for c in df.columns
+    })
+
+# Textos que pandas.read_csv toma como NaN por defecto (ver na_values en su documentación)
+NA_TEXTOS = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+             '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+def read_csv_arrow(data, cols):
+    # pyarrow lee su propio encabezado (como pandas, saltea líneas vacías al inicio);
+    # las columnas se eligen por posición sobre ese esquema y luego se renombran
+    header = pa_csv.open_csv(BytesIO(data)).schema.names
+    source = [header[i] for i in cols]
+    if any(header.count(n) > 1 for n in source): raise ValueError("Encabezados duplicados")
+    table = pa_csv.read_csv(
+        BytesIO(data),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=source,
+            column_types={src: pa.string() for src, n in zip(source, cols.values()) if not n.startswith('Precio_')},
+            # Mismos textos nulos que pandas ('None', '<NA>', 'NA', ...), también en columnas de texto
+            null_values=NA_TEXTOS, strings_can_be_null=True
+        )
+    )
+    return table.rename_columns(list(cols.values())).to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow', na_value=np.nan)}.get)
+
+@st.cache_data(show_spinner=False, max_entries=10)
+def parse_file(name, data, cols):
+    # Solo se parsean las columnas usadas; códigos y descripciones se leen como texto
+    usecols = sorted(cols)
+    names = [cols[i] for i in usecols]
+    dtype = {n: str for n in names if not n.startswith('Precio_')}
+    if name.endswith('.csv'):
+        # pyarrow.csv (multihilo); read_csv(engine='pyarrow') no acepta posiciones en usecols
+        try: df = read_csv_arrow(data, cols)
+        except Exception: df = pd.read_csv(BytesIO(data), usecols=usecols, names=names, header=0, dtype=dtype)
+    else:
+        # calamine (Rust) lee el xlsx en streaming; openpyxl solo como respaldo
+        try: df = pd.read_excel(BytesIO(data), engine='calamine', usecols=usecols, names=names, header=0, dtype=dtype)
+        except Exception: df = pd.read_excel(BytesIO(data), engine='openpyxl', usecols=usecols, names=names, header=0, dtype=dtype)
+    return normalize(df[list(cols.values())])
+
+def load_data(name, data, cols):
+    # Cacheado por contenido: re-ejecutar el análisis con los mismos archivos no vuelve a parsear
     try:
-        if file.name.endswith('.csv'): return pd.read_csv(file)
-        else: return pd.read_excel(file)
+        return parse_file(name, data, cols)
     except Exception as e:
-        st.error(f"Error cargando archivo {file.name}: {e}")
-        return None
+        raise ValueError(f"Error cargando archivo {name}: {e}") from e
+
+@st.cache_data(show_spinner="Generando reporte...", max_entries=5)
+def build_report(erp, pub, cost):
+    # Pasos 1-6 como función pura de los archivos (nombre, bytes): un rerun por widget/pestaña no recalcula nada
+    # --- PASO 1: PROCESAR ERP ---
+    erp_subset = load_data(*erp, ERP_COLS)
+
+    # --- PASO 2: PROCESAR PÚBLICO ---
+    pub_subset = load_data(*pub, PUB_COLS)
+    cost_subset = load_data(*cost, COST_COLS) if cost else None
+
+    # Una sola codificación para los tres archivos: ambos joins reutilizan las mismas categorías
+    codes = [erp_subset['Codigo_ERP'], pub_subset['Codigo_Prov']] + ([cost_subset['Codigo_Prov']] if cost else [])
+    erp_subset['Codigo_ERP'], pub_subset['Codigo_Prov'], *cost_codes = shared_category(*codes)
+
+    # --- PASO 3: MERGE ---
+    erp_by_code = erp_subset.set_index('Codigo_ERP')
+    df_main = join_on_code(pub_subset, erp_by_code, how='inner')
+
+    # --- PASO 4: CÁLCULOS PÚBLICOS ---
+    cents, missing = diff_cents(df_main['Precio_Publico_Prov'], df_main['Precio_Publico_ERP'])
+    df_main['Diferencia_$$'] = np.where(missing, np.nan, cents / 100)
+    base = df_main['Precio_Publico_ERP'].to_numpy()
+    pct = np.divide(df_main['Diferencia_$$'].to_numpy(), base, out=np.zeros(len(base)), where=base != 0)
+    df_main['Diferencia_%'] = (pct * 100).round(2)
+    df_main['Estado'] = determine_status_col(cents, missing)
+
+    # Similitud
+    df_main['Porcentaje_Similitud_Descripcion'] = calculate_similarity(df_main['Descripción_Insignia'], df_main['Desc_Prov']).round(2)
+
+    # --- PASO 5: COSTOS ---
+    if cost:
+        cost_subset['Codigo_Prov'] = cost_codes[0]
+        cost_by_code = cost_subset.set_index('Codigo_Prov')['Precio_Costo_Prov']
+        df_final = join_on_code(df_main, cost_by_code, how='left')
+
+        cents, missing = diff_cents(df_final['Precio_Costo_Prov'], df_final['Precio_Costo_ERP'])
+        df_final['Diferencia_$$_Costo'] = np.where(missing, np.nan, cents / 100)
+        base = df_final['Precio_Costo_ERP'].to_numpy()
+        pct = np.divide(df_final['Diferencia_$$_Costo'].to_numpy(), base, out=np.zeros(len(base)), where=~np.isnan(base) & (base != 0))
+        df_final['Diferencia_%_Costo'] = (pct * 100).round(2)
+        df_final['Estado_Costo'] = determine_status_col(cents, missing)
+    else:
+        # assign arma el frame nuevo sin duplicar df_main (copy-on-write)
+        df_final = df_main.assign(**{
+            'Precio_Costo_Prov': 0.0, 'Diferencia_$$_Costo': 0.0, 'Diferencia_%_Costo': 0.0,
+            'Estado_Costo': pd.Categorical.from_codes(np.zeros(len(df_main), dtype=np.int8), categories=['Sin Info Costo'])
+        })
+
+    # --- PASO 6: ESTRUCTURA FINAL ---
+    # La selección por lista y rename ya devuelven un frame nuevo: sin .copy() extra
+    reporte_unificado = df_final[[
+        'Codigo_Insignia', 'Descripción_Insignia', 'Desc_Prov', 'Porcentaje_Similitud_Descripcion',
+        'Codigo_Prov', 'Precio_Publico_ERP', 'Precio_Publico_Prov', 'Diferencia_$$', 'Diferencia_%', 'Estado',
+        'Precio_Costo_ERP', 'Precio_Costo_Prov', 'Diferencia_$$_Costo', 'Diferencia_%_Costo', 'Estado_Costo'
+    ]].rename(columns={
+        'Diferencia_$$_Costo': 'Diferencia_$$ (Costo)',
+        'Diferencia_%_Costo': 'Diferencia_% (Costo)',
+        'Estado_Costo': 'Estado (Costo)'
+    })
+
+    counts = {'ERP': len(erp_subset), 'Pub': len(pub_subset), 'Cost': len(cost_subset) if cost else 0}
+    # La auditoría se arma recién al abrir su pestaña (compute_audit); acá solo se devuelven las fuentes
+    return reporte_unificado, (erp_subset, pub_subset), counts
+
+def compute_audit(erp_subset, pub_subset):
+    audit = {}
+    # Ambos lados comparten categorías: una tabla de presencia por código (+1 para NaN = -1)
+    # da las dos diferencias sin hashing ni ordenamiento
+    erp_ids = erp_subset['Codigo_ERP'].cat.codes.to_numpy() + 1
+    pub_ids = pub_subset['Codigo_Prov'].cat.codes.to_numpy() + 1
+    n_codes = len(erp_subset['Codigo_ERP'].cat.categories) + 1
+    in_erp = np.zeros(n_codes, dtype=bool); in_erp[erp_ids] = True
+    in_pub = np.zeros(n_codes, dtype=bool); in_pub[pub_ids] = True
+    audit['En_Prov_No_ERP'] = pub_subset[~in_erp[pub_ids]]
+    audit['En_ERP_No_Prov'] = erp_subset[~in_pub[erp_ids]]
+    return audit
 
 # --- 4. GESTIÓN DE ESTADO ---
 if 'analyzed' not in st.session_state: st.session_state['analyzed'] = False
 if 'final_report' not in st.session_state: st.session_state['final_report'] = None
-if 'audit_data' not in st.session_state: st.session_state['audit_data'] = {}
+if 'audit_data' not in st.session_state: st.session_state['audit_data'] = None
+if 'audit_sources' not in st.session_state: st.session_state['audit_sources'] = None
 if 'input_counts' not in st.session_state: st.session_state['input_counts'] = {}
 
 # --- 5. INTERFAZ: BARRA LATERAL ---
@@ -94,102 +314,26 @@ if click_analysis:
         st.error("⚠️ Error: El archivo de Precio Público (B1) es necesario.")
         st.session_state['analyzed'] = False
     else:
-        progress_bar = st.progress(0, text="Iniciando motor de análisis...")
         try:
-            # --- PASO 1: PROCESAR ERP ---
-            df_erp = load_data(erp_file)
-            erp_subset = df_erp.iloc[:, [0, 2, 18, 14, 20]].copy()
-            erp_subset.columns = ['Codigo_Insignia', 'Descripción_Insignia', 'Codigo_ERP', 'Precio_Publico_ERP', 'Precio_Costo_ERP']
-            
-            erp_subset['Codigo_ERP'] = erp_subset['Codigo_ERP'].astype(str).str.strip()
-            erp_subset['Codigo_Insignia'] = erp_subset['Codigo_Insignia'].astype(str).str.strip()
-            erp_subset['Descripción_Insignia'] = erp_subset['Descripción_Insignia'].astype(str).str.strip()
-            erp_subset['Precio_Publico_ERP'] = erp_subset['Precio_Publico_ERP'].apply(clean_currency).round(2)
-            erp_subset['Precio_Costo_ERP'] = erp_subset['Precio_Costo_ERP'].apply(clean_currency).round(2)
-            
-            set_erp_codes = set(erp_subset['Codigo_ERP'])
-            
-            # --- PASO 2: PROCESAR PÚBLICO ---
-            progress_bar.progress(25, text="Procesando Precios Públicos...")
-            df_pub = load_data(prov_pub_file)
-            pub_subset = df_pub.iloc[:, [0, 1, 2]].copy()
-            pub_subset.columns = ['Codigo_Prov', 'Desc_Prov', 'Precio_Publico_Prov']
-            pub_subset['Codigo_Prov'] = pub_subset['Codigo_Prov'].astype(str).str.strip()
-            pub_subset['Desc_Prov'] = pub_subset['Desc_Prov'].astype(str).str.strip()
-            pub_subset['Precio_Publico_Prov'] = pub_subset['Precio_Publico_Prov'].apply(clean_currency).round(2)
-            
-            set_pub_codes = set(pub_subset['Codigo_Prov'])
-
-            # --- PASO 3: MERGE ---
-            df_main = pd.merge(pub_subset, erp_subset, left_on='Codigo_Prov', right_on='Codigo_ERP', how='inner')
-
-            # --- PASO 4: CÁLCULOS PÚBLICOS ---
-            df_main['Diferencia_$$'] = (df_main['Precio_Publico_Prov'] - df_main['Precio_Publico_ERP']).round(2)
-            df_main['Diferencia_%'] = df_main.apply(lambda x: ((x['Diferencia_$$'] / x['Precio_Publico_ERP']) * 100) if x['Precio_Publico_ERP'] != 0 else 0.0, axis=1).round(2)
-            df_main['Estado'] = df_main['Diferencia_$$'].apply(determine_status)
-            
-            # Similitud (Puede tardar un poco)
-            df_main['Porcentaje_Similitud_Descripcion'] = df_main.apply(calculate_similarity, axis=1).round(2)
-
-            # --- PASO 5: COSTOS ---
-            progress_bar.progress(60, text="Integrando Costos...")
-            if prov_cost_file:
-                df_cost = load_data(prov_cost_file)
-                cost_subset = df_cost.iloc[:, [0, 9]].copy()
-                cost_subset.columns = ['Codigo_Prov', 'Precio_Costo_Prov']
-                cost_subset['Codigo_Prov'] = cost_subset['Codigo_Prov'].astype(str).str.strip()
-                cost_subset['Precio_Costo_Prov'] = cost_subset['Precio_Costo_Prov'].apply(clean_currency).round(2)
-                
-                df_final = pd.merge(df_main, cost_subset[['Codigo_Prov', 'Precio_Costo_Prov']], on='Codigo_Prov', how='left')
-                
-                df_final['Diferencia_$$_Costo'] = (df_final['Precio_Costo_Prov'] - df_final['Precio_Costo_ERP']).round(2)
-                df_final['Diferencia_%_Costo'] = df_final.apply(lambda x: ((x['Diferencia_$$_Costo'] / x['Precio_Costo_ERP']) * 100) if (pd.notnull(x['Precio_Costo_ERP']) and x['Precio_Costo_ERP'] != 0) else 0.0, axis=1).round(2)
-                df_final['Estado_Costo'] = df_final['Diferencia_$$_Costo'].apply(determine_status)
-            else:
-                df_final = df_main.copy()
-                df_final['Precio_Costo_Prov'] = 0.0
-                df_final['Diferencia_$$_Costo'] = 0.0
-                df_final['Diferencia_%_Costo'] = 0.0
-                df_final['Estado_Costo'] = "Sin Info Costo"
-
-            # --- PASO 6: ESTRUCTURA FINAL ---
-            reporte_unificado = df_final[[
-                'Codigo_Insignia', 'Descripción_Insignia', 'Desc_Prov', 'Porcentaje_Similitud_Descripcion',
-                'Codigo_Prov', 'Precio_Publico_ERP', 'Precio_Publico_Prov', 'Diferencia_$$', 'Diferencia_%', 'Estado',
-                'Precio_Costo_ERP', 'Precio_Costo_Prov', 'Diferencia_$$_Costo', 'Diferencia_%_Costo', 'Estado_Costo'
-            ]].copy()
-            
-            reporte_unificado.rename(columns={
-                'Diferencia_$$_Costo': 'Diferencia_$$ (Costo)',
-                'Diferencia_%_Costo': 'Diferencia_% (Costo)',
-                'Estado_Costo': 'Estado (Costo)'
-            }, inplace=True)
-
-            # Auditoría
-            audit = {}
-            audit['En_Prov_No_ERP'] = pub_subset[~pub_subset['Codigo_Prov'].isin(set_erp_codes)]
-            audit['En_ERP_No_Prov'] = erp_subset[~erp_subset['Codigo_ERP'].isin(set_pub_codes)]
-            
-            st.session_state['final_report'] = reporte_unificado
-            st.session_state['audit_data'] = audit
-            st.session_state['input_counts'] = {
-                'ERP': len(df_erp), 'Pub': len(df_pub), 'Cost': len(df_cost) if prov_cost_file else 0
-            }
+            files = [(f.name, f.getvalue()) if f is not None else None for f in (erp_file, prov_pub_file, prov_cost_file)]
+            report, audit_sources, counts = build_report(*files)
+
+            st.session_state['final_report'] = report
+            st.session_state['audit_sources'] = audit_sources
+            st.session_state['audit_data'] = None
+            st.session_state['input_counts'] = counts
             st.session_state['analyzed'] = True
-            
-            progress_bar.progress(100, text="¡Análisis Completado!")
-            time.sleep(0.5)
-            progress_bar.empty()
 
         except Exception as e:
             st.error(f"❌ Error crítico: {e}")
             st.session_state['analyzed'] = False
 
 # --- 7. VISUALIZACIÓN OPTIMIZADA ---
-if st.session_state['analyzed']:
+# Fragmento: descargas y demás widgets de los resultados solo re-ejecutan esta sección, no el script completo
+@st.fragment
+def render_results():
     df = st.session_state['final_report']
     counts = st.session_state['input_counts']
-    audit = st.session_state['audit_data']
 
     c1, c2, c3, c4 = st.columns(4)
     c1.metric("Registros ERP", f"{counts['ERP']:,}")
@@ -200,66 +344,67 @@ if st.session_state['analyzed']:
 
     st.divider()
 
-    tab_main, tab_audit = st.tabs(["📊 Reporte Unificado", "🔍 Auditoría"])
+    # on_change='rerun' hace las pestañas perezosas: solo se ejecuta la abierta (y solo el fragmento)
+    tab_main, tab_audit = st.tabs(["📊 Reporte Unificado", "🔍 Auditoría"], key='tabs', on_change='rerun')
 
     with tab_main:
-        st.subheader("Vista Previa (Primeros 1,000 registros)")
-        st.caption("ℹ️ Se muestran solo las primeras filas para mayor velocidad. El archivo descargable contiene TODO.")
-        
-        # Funciones de color
-        def color_status(val):
-            if val == 'Precio subió': return 'color: #EF553B; font-weight: bold'
-            elif val == 'Precio bajó': return 'color: #636EFA; font-weight: bold'
-            elif val == 'Precio sin cambios': return 'color: #00CC96'
-            return ''
-            
-        def color_similitud(val):
-            if pd.isna(val): return ''
-            if val < 50: return 'color: #EF553B; font-weight: bold'
-            elif val < 80: return 'color: #FFA15A'
-            return 'color: #00CC96'
-
-        # OPTIMIZACIÓN: Solo mostramos df.head(1000) en pantalla
-        # Esto evita que el navegador se congele
-        preview_df = df.head(1000)
-
-        st.dataframe(
-            preview_df.style.format({
-                'Precio_Publico_ERP': '${:,.2f}', 'Precio_Publico_Prov': '${:,.2f}',
-                'Diferencia_$$': '${:,.2f}', 'Diferencia_%': '{:.2f}%',
-                'Porcentaje_Similitud_Descripcion': '{:.1f}%',
-                'Precio_Costo_ERP': '${:,.2f}', 'Precio_Costo_Prov': '${:,.2f}',
-                'Diferencia_$$ (Costo)': '${:,.2f}', 'Diferencia_% (Costo)': '{:.2f}%'
+        if tab_main.open:
+            st.subheader("Vista Previa (Primeros 1,000 registros)")
+            st.caption("ℹ️ Se muestran solo las primeras filas para mayor velocidad. El archivo descargable contiene TODO.")
+
+            # OPTIMIZACIÓN: Solo mostramos df.head(1000) en pantalla
+            # Esto evita que el navegador se congele
+            preview_df = df.head(1000).assign(**{
+                'Estado': with_status_icons(df['Estado'].head(1000)),
+                'Estado (Costo)': with_status_icons(df['Estado (Costo)'].head(1000))
             })
-            .map(color_status, subset=['Estado', 'Estado (Costo)']) 
-            .map(color_similitud, subset=['Porcentaje_Similitud_Descripcion']),
-            use_container_width=True
-        )
+            sim_pos = preview_df.columns.get_loc('Porcentaje_Similitud_Descripcion')
+            preview_df.insert(sim_pos, 'Nivel_Similitud', similarity_band(preview_df['Porcentaje_Similitud_Descripcion']))
 
-        # Descarga Excel (USA EL DATAFRAME COMPLETO 'df', NO EL PREVIEW)
-        output = BytesIO()
-        try:
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                df.to_excel(writer, index=False, sheet_name='Reporte_Unificado')
-        except:
-            with pd.ExcelWriter(output) as writer:
-                df.to_excel(writer, index=False, sheet_name='Reporte_Unificado')
-        
-        st.download_button(
-            label="📥 Descargar Reporte Completo (Excel)",
-            data=output.getvalue(),
-            file_name="Reporte_Precios_Unificado.xlsx",
-            mime="application/vnd.ms-excel"
-        )
+            # Formato en el navegador (column_config) en lugar de Styler, que arma HTML/CSS celda por celda en Python
+            money = st.column_config.NumberColumn(format='dollar')
+            pct = st.column_config.NumberColumn(format='%.2f%%')
+            st.dataframe(
+                preview_df,
+                column_config={
+                    'Precio_Publico_ERP': money, 'Precio_Publico_Prov': money,
+                    'Diferencia_$$': money, 'Diferencia_%': pct,
+                    'Nivel_Similitud': st.column_config.TextColumn('Nivel', width='small'),
+                    'Porcentaje_Similitud_Descripcion': st.column_config.ProgressColumn(format='%.1f%%', min_value=0, max_value=100),
+                    'Precio_Costo_ERP': money, 'Precio_Costo_Prov': money,
+                    'Diferencia_$$ (Costo)': money, 'Diferencia_% (Costo)': pct
+                },
+                width='stretch'
+            )
+
+            # Descarga (USA EL DATAFRAME COMPLETO 'df', NO EL PREVIEW)
+            # Solo se genera el formato elegido, recién al hacer clic (y queda cacheado), no en cada rerun
+            formato = st.radio("Formato de descarga", list(FORMATOS_DESCARGA), horizontal=True)
+            build, ext, mime = FORMATOS_DESCARGA[formato]
+            st.download_button(
+                label=f"📥 Descargar Reporte Completo ({formato})",
+                data=lambda: build(df),
+                file_name=f"Reporte_Precios_Unificado.{ext}",
+                mime=mime,
+                on_click='ignore'
+            )
 
     with tab_audit:
-        c_a, c_b = st.columns(2)
-        with c_a:
-            st.warning(f"En Proveedor pero NO en ERP: {len(audit['En_Prov_No_ERP'])}")
-            st.dataframe(audit['En_Prov_No_ERP'].head(1000), use_container_width=True)
-        with c_b:
-            st.info(f"En ERP pero NO en Proveedor: {len(audit['En_ERP_No_Prov'])}")
-            st.dataframe(audit['En_ERP_No_Prov'][['Codigo_ERP','Precio_Publico_ERP']].head(1000), use_container_width=True)
+        if tab_audit.open:
+            # Se calcula una vez por reporte, al abrir la pestaña por primera vez
+            if st.session_state['audit_data'] is None:
+                st.session_state['audit_data'] = compute_audit(*st.session_state['audit_sources'])
+            audit = st.session_state['audit_data']
 
+            c_a, c_b = st.columns(2)
+            with c_a:
+                st.warning(f"En Proveedor pero NO en ERP: {len(audit['En_Prov_No_ERP'])}")
+                st.dataframe(audit['En_Prov_No_ERP'].head(1000), width='stretch')
+            with c_b:
+                st.info(f"En ERP pero NO en Proveedor: {len(audit['En_ERP_No_Prov'])}")
+                st.dataframe(audit['En_ERP_No_Prov'][['Codigo_ERP','Precio_Publico_ERP']].head(1000), width='stretch')
+
+if st.session_state['analyzed']:
+    render_results()
 else:
     st.markdown("<div style='text-align: center; margin-top: 50px; opacity: 0.7;'><h3>👋 Bienvenido</h3><p>Carga los archivos para generar el análisis.</p></div>", unsafe_allow_html=True)
\ No newline at end of file